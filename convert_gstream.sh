@@ -1,12 +1,31 @@
 #!/bin/bash -x
 
 FACTOR=0.5
-if [ "$1" == "--factor" ]; then
-    FACTOR=${2:-0.5}
-    shift 2
-fi
+FILES=()
+while [ $# -gt 0 ]; do
+    case "$1" in
+        --factor)
+            FACTOR=${2:-0.5}
+            shift 2 || break
+            ;;
+        --files-from)
+            if [ $# -lt 2 ]; then
+                echo "--files-from needs a filename" >&2
+                exit 1
+            fi
+            # One filename per line
+            mapfile -t LISTED < "$2"
+            FILES+=("${LISTED[@]}")
+            shift 2
+            ;;
+        *)
+            FILES+=("$1")
+            shift
+            ;;
+    esac
+done
 
-for i in "$@"; do
+for i in "${FILES[@]}"; do
     FULLFILE=$(realpath $i)
     BASEFILE=$(basename $i)
     BASEFILE=${BASEFILE%%.*}
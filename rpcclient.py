@@ -4,13 +4,18 @@
 import argparse
 import logging
 import json
-from flask_jsonrpc.proxy import ServiceProxy
 import os
 import sys
 import re
 import time
+import uuid
 import configparser
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 FORMAT = "%(asctime)s: %(name)s:%(lineno)d (%(threadName)s) - %(levelname)s - %(message)s"
 logging.basicConfig(format=FORMAT)
 logging.getLogger(None).setLevel(logging.INFO)
@@ -399,7 +404,15 @@ def print_response(response):
                     print(result)
                 return 0
 
-    print(json.dumps(response, indent=2))
+    if orjson:
+        # Much faster than json for large poll output
+        sys.stdout.flush()
+        sys.stdout.buffer.write(orjson.dumps(response,
+                                             option=orjson.OPT_INDENT_2))
+        sys.stdout.buffer.write(b"\n")
+        sys.stdout.buffer.flush()
+    else:
+        print(json.dumps(response, indent=2))
 
     if "errors" in response:
         return 1
@@ -435,37 +448,62 @@ if args.dryrun:
 
 apiurl = "http://%s:5005/api" % config.get("serverIP", None)
 logger.info("Using service at %s" % apiurl)
-proxy = ServiceProxy(apiurl)
-apifunc = getattr(proxy.App, progname)
+
+# Deferred so --help and --dryrun don't pay for importing requests
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Reuse one keep-alive connection for the initial call and all the polls
+session = requests.Session()
+session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=4,
+                                     max_retries=Retry(total=3,
+                                                       backoff_factor=0.2)))
+
+
+def call(method, **params):
+    # The server uses the request id as the task id, so it must be unique
+    payload = {
+        "jsonrpc": "2.0",
+        "method": "App.%s" % method,
+        "params": params,
+        "id": str(uuid.uuid4()),
+    }
+    response = session.post(apiurl, json=payload, timeout=60)
+    return response.json()
+
 
 params = parameters[progname].get('params', [])
 apiparams = {param: config.get(param, None) for param in params}
 
 if progname != "poll":
-    response = apifunc(**apiparams)
+    response = call(progname, **apiparams)
 
     retCode = print_response(response)
 
     if not config.get("poll", False):
         sys.exit(retCode)
 
-    uuid = response['id']
+    taskId = response['id']
 else:
-    uuid = config.get("id", None)
+    taskId = config.get("id", None)
 
+# Only ask for the output we haven't seen yet
+since = 0
 sleepTime = 0
 while True:
     sleepTime = max(min(sleepTime * 2, 256), 1)
     logger.info("Sleeping for %ss" % sleepTime)
     time.sleep(sleepTime)
 
-    response = proxy.App.poll(id=uuid)
+    response = call("poll", id=taskId, since=since)
     retCode = print_response(response)
     if retCode:
         output = None
         break
 
     output = response.get("result", {})
+    since = output.get("next", since)
     if output.get("status", "complete") == "complete":
         break
 
@@ -2,34 +2,105 @@
 # vim:ts=4:sw=4:ai:et:si:sts=4
 
 import logging
-from flask import Flask, request
+from logging.handlers import QueueHandler, QueueListener
+import atexit
+from flask import Flask, Response, request
 from flask_jsonrpc import JSONRPC
 import os
 import sys
 import shutil
 import json
-from subprocess import Popen, PIPE, STDOUT
-from bs4 import BeautifulSoup
-from threading import Thread, Lock
+import asyncio
+from asyncio.subprocess import PIPE, STDOUT
+from xml.sax.saxutils import escape
+from threading import Thread, Event, Lock
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from queue import Queue
 import time
-import selectors
 from typing import List, Dict, Any
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 logdir = "/opt/video/render/logs"
 logfile = os.path.join(logdir, "rpcserver.log")
 
 FORMAT = "%(asctime)s: %(name)s:%(lineno)d (%(threadName)s) - %(levelname)s - %(message)s"
-logging.basicConfig(filename=logfile, format=FORMAT)
+
+
+# Log through a queue so the request and output threads never block on the
+# file write, the listener thread owns the actual handlers
+def start_logging(handlers):
+    global logQueue, logListener
+    root = logging.getLogger(None)
+    for handler in list(root.handlers):
+        if isinstance(handler, QueueHandler) or handler in handlers:
+            root.removeHandler(handler)
+
+    logQueue = Queue(-1)
+    root.addHandler(QueueHandler(logQueue))
+    logListener = QueueListener(logQueue, *handlers,
+                                respect_handler_level=True)
+    logListener.start()
+
+
+def stop_logging():
+    # Flush the queue and log directly to the handlers from then on
+    global logListener
+    if not logListener:
+        return
+
+    logListener.stop()
+    root = logging.getLogger(None)
+    for handler in list(root.handlers):
+        if isinstance(handler, QueueHandler):
+            root.removeHandler(handler)
+    for handler in logListener.handlers:
+        root.addHandler(handler)
+    logListener = None
+
+
+logQueue = None
+logListener = None
+fileHandler = logging.FileHandler(logfile)
+fileHandler.setFormatter(logging.Formatter(fmt=FORMAT))
+start_logging([fileHandler])
+atexit.register(stop_logging)
 logging.getLogger(None).setLevel(logging.INFO)
 logging.captureWarnings(True)
 logger = logging.getLogger(__name__)
 
+
+class FastQueue(object):
+    # Each queue only has one consumer (its HandlerThread), so a deque plus
+    # an Event is enough, and avoids the Condition used by queue.Queue
+    def __init__(self):
+        self.deque = deque()
+        self.event = Event()
+
+    def put(self, item, block=True, timeout=None):
+        self.deque.append(item)
+        self.event.set()
+
+    def get(self):
+        while True:
+            try:
+                return self.deque.popleft()
+            except IndexError:
+                self.event.clear()
+                # Recheck in case a put() landed before the clear
+                if not self.deque:
+                    self.event.wait()
+
+
 queues = {
-    "cpu-bound": Queue(),
-    "internal-network-bound": Queue(),
-    "external-network-bound": Queue(),
-    "local": Queue(),
+    "cpu-bound": FastQueue(),
+    "internal-network-bound": FastQueue(),
+    "external-network-bound": FastQueue(),
+    "local": FastQueue(),
 }
 
 queueMap = {
@@ -45,60 +116,45 @@ queueMap = {
     "make_slideshow": "cpu-bound",
 }
 
+BATCHFILE_TEMPLATE = """<?xml version="1.0" encoding="utf-8"?>
+<JOBS WARN="1">
+  <JOB EDL_PATH="{edlfile}" STRATEGY="0" ENABLED="1" ELAPSED="0">
+    <ASSET SRC="{outputfile}">
+      <FOLDER NUMBER="6"></FOLDER>
+      <FORMAT TYPE="FFMPEG" USE_HEADER="1" FFORMAT="mp4"></FORMAT>
+      <AUDIO CHANNELS="2" RATE="48000" BITS="16" BYTE_ORDER="1" SIGNED="1" HEADER="0" DITHER="0" ACODEC="h265.mp4" AUDIO_LENGTH="0"></AUDIO>
+      <VIDEO ACTUAL_HEIGHT="0" ACTUAL_WIDTH="0" HEIGHT="0" WIDTH="0" LAYERS="0" PROGRAM="-1" FRAMERATE="0" VCODEC="h264.mp4" VIDEO_LENGTH="0" SINGLE_FRAME="0" INTERLACE_AUTOFIX="1" INTERLACE_MODE="UNKNOWN" INTERLACE_FIXMETHOD="SHIFT_UPONE" REEL_NAME="cin0000" REEL_NUMBER="0" TCSTART="0" TCEND="0" TCFORMAT="0"></VIDEO>
+    </ASSET>
+    PATH {outputfile}
+    AUDIO_CODEC h265.mp4
+    VIDEO_CODEC h264.mp4
+    FF_AUDIO_OPTIONS strict -2
+    FF_AUDIO_BITRATE 0
+    FF_VIDEO_OPTIONS crf=17
+    FF_VIDEO_BITRATE 0
+    FF_VIDEO_QUALITY -1
+  </JOB>
+</JOBS>
+"""
+
 handlerThreads = {}
+handlerThreadsLock = Lock()
 handlers = {}
-outputThread = None
+eventLoopThread = None
+eventLoopLock = Lock()
 
 
-class OutputThread(Thread):
+class EventLoopThread(Thread):
     def __init__(self):
         Thread.__init__(self)
 
-        self.sel = selectors.DefaultSelector()
-        self.idMap = {}
-        self.name = "OutputThread"
+        self.loop = asyncio.new_event_loop()
+        self.name = "EventLoopThread"
         self.daemon = True
-        global handlers
-        self.handlers = handlers
 
     def run(self):
-        while True:
-            events = self.sel.select(0.1)
-            for (key, mask) in events:
-                callback = key.data
-                callback(key.fileobj, mask)
-
-    def add(self, id_):
-        fd = self.handlers[id_]['pipe']
-        self.idMap[fd] = id_
-        logger.info("Adding %s (%s)" % (fd, id_))
-        try:
-            self.sel.register(fd, selectors.EVENT_READ, self.read)
-        except KeyError:
-            pass
-
-    def removeId(self, id_):
-        fd = self.handlers[id_]['pipe']
-        logger.info("Removing %s (%s)" % (fd, id_))
-        self.remove(fd)
-
-    def remove(self, fd):
-        del self.idMap[fd]
-        self.sel.unregister(fd)
-        fd.close()
-
-    def read(self, fd, mask):
-        data = fd.read(1024)
-        id_ = self.idMap.get(fd, None)
-        logger.info("Data len: %s" % len(data))
-        if data:
-            handler = self.handlers.get(id_, None)
-            if id_ and handler:
-                with handler['lock']:
-                    handler['data'].append(data)
-                return
-
-        self.removeId(id_)
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
 
 
 def get_remote_ip(remoteIP=None):
@@ -114,6 +170,70 @@ def get_remote_ip(remoteIP=None):
     return remoteIP
 
 
+def walk_files(path):
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                yield from walk_files(entry.path)
+            elif entry.is_file():
+                yield entry.path
+
+
+def group_outputs(files):
+    # convert_gstream.sh writes <input>/../{edit,proxy}/<name up to the first
+    # dot>.mkv, so e.g. clip.mp4 and clip.mov produce the same files.  Keep
+    # those together so they're converted one after the other, not at once.
+    groups = {}
+    for file_ in files:
+        fullpath = os.path.realpath(file_)
+        basedir = os.path.dirname(os.path.dirname(fullpath))
+        stem = os.path.basename(fullpath).split(".", 1)[0]
+        groups.setdefault((basedir, stem), []).append(file_)
+    return groups
+
+
+def utf8_boundary(data):
+    # Offset just past the last complete UTF-8 character, so a multi-byte
+    # character split between reads isn't decoded in two halves
+    for i in range(1, min(4, len(data)) + 1):
+        byte = data[-i]
+        if byte & 0xC0 == 0x80:
+            # Continuation byte, keep looking for the lead byte
+            continue
+        if byte >= 0xF0:
+            length = 4
+        elif byte >= 0xE0:
+            length = 3
+        elif byte >= 0xC0:
+            length = 2
+        else:
+            length = 1
+        if length > i:
+            return len(data) - i
+        break
+    return len(data)
+
+
+def drain_output(handler, final=False):
+    chunks = [handler.get('partial', b"")]
+    pending = handler.get('data', None)
+    while pending:
+        try:
+            chunks.append(pending.popleft())
+        except IndexError:
+            break
+    chunk = b"".join(chunks)
+
+    # Hold back an incomplete trailing character until the rest arrives,
+    # unless the command is done and nothing more is coming
+    boundary = len(chunk) if final else utf8_boundary(chunk)
+    handler['partial'] = chunk[boundary:]
+    chunk = chunk[:boundary]
+    if chunk:
+        handler['polldata'].extend(chunk)
+    return chunk
+
+
 class HandlerThread(Thread):
     def __init__(self, queue, queueName, handlers):
         Thread.__init__(self)
@@ -122,6 +242,8 @@ class HandlerThread(Thread):
         self.name = "%s-handler" % queueName
         self.daemon = True
         self.handlers = handlers
+        # Only the methods in queueMap can be dispatched to
+        self.dispatch = {method: getattr(self, method) for method in queueMap}
 
     def run(self):
         while True:
@@ -139,20 +261,23 @@ class HandlerThread(Thread):
             if id_ not in self.handlers:
                 self.handlers[id_] = {}
             data = self.handlers[id_]
-            data['lock'] = Lock()
             data['status'] = 'in-progress'
             data['processTime'] = time.time()
             data['queueTime'] = time.time() - data['queueTime']
-            data['data'] = []
-            data['polldata'] = []
+            # deque append/popleft are atomic, so the output thread and
+            # poll() can share it without a lock
+            data['data'] = deque()
+            data['polldata'] = bytearray()
+            data['partial'] = b""
+            data.setdefault('newData', Event())
             logger.info("Starting handler for method %s (id %s)" %
                         (method, id_))
             args['myId'] = id_
             try:
-                if not hasattr(self, method):
+                methodFunc = self.dispatch.get(method, None)
+                if methodFunc is None:
                     raise Exception("No thread handler exists for method %s" %
                                     method)
-                methodFunc = getattr(self, method)
                 output = methodFunc(**args)
                 if output:
                     data['results'] = output
@@ -161,34 +286,36 @@ class HandlerThread(Thread):
 
             data['status'] = "complete"
             data['processTime'] = time.time() - data['processTime']
+            data['newData'].set()
             logger.info("Finishing handler for method %s (id %s)" %
                         (method, id_))
 
-    def execCommand(self, command, id_):
-        global outputThread
+    def execCommand(self, command, id_, bucket=None):
+        global eventLoopThread
         if not isinstance(command, list):
             command = command.split()
 
+        command = [commandPaths.get(command[0], command[0])] + command[1:]
         logger.info("Running %s" % " ".join(command))
-        if not outputThread or not outputThread.is_alive():
-            outputThread = OutputThread()
-            outputThread.start()
+        # convert_inputs runs commands from several threads at once
+        with eventLoopLock:
+            if not eventLoopThread or not eventLoopThread.is_alive():
+                eventLoopThread = EventLoopThread()
+                eventLoopThread.start()
 
-        retCode = -1
         handler = self.handlers[id_]
-        with Popen(command, shell=False, stdin=None, stdout=PIPE,
-                   stderr=STDOUT, bufsize=0) as p:
-            handler['pipe'] = p.stdout
-            outputThread.add(id_)
-            p.wait()
-            retCode = p.returncode
-
-        handler['pipe'].close()
+        if bucket is None:
+            bucket = handler['data']
+        future = asyncio.run_coroutine_threadsafe(
+            self.runCommand(command, handler, bucket), eventLoopThread.loop)
+        retCode = future.result()
 
         output = None
-        with handler['lock']:
-            if handler['data']:
-                output = b" ".join(handler['data']).decode("utf-8")
+        if bucket:
+            partial = b""
+            if bucket is handler['data']:
+                partial = handler.get('partial', b"")
+            output = (partial + b"".join(bucket)).decode("utf-8", "replace")
 
         if retCode:
             message = "Command: %s returned %s" % (" ".join(command), retCode)
@@ -199,6 +326,21 @@ class HandlerThread(Thread):
 
         handler['result'] = output
 
+    async def runCommand(self, command, handler, bucket):
+        proc = await asyncio.create_subprocess_exec(*command, stdout=PIPE,
+                                                    stderr=STDOUT)
+        while True:
+            data = await proc.stdout.read(65536)
+            if not data:
+                break
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Data len: %s" % len(data))
+            bucket.append(data)
+            if bucket is handler['data']:
+                handler['newData'].set()
+
+        return await proc.wait()
+
     def upload_inputs(self, myId, project, remoteIP=None, force=False):
         path = os.path.join("/opt/video/render/video", project, "input", "")
         os.makedirs(path, exist_ok=True)
@@ -214,24 +356,66 @@ class HandlerThread(Thread):
             factor = 0.5
 
         if not files:
-            files = []
-            for (root, dirs, files_) in os.walk(path):
-                files.extend([os.path.join(root, file_) for file_ in files_])
+            files = list(walk_files(path))
         else:
+            # Dedupe and check existing files
             files = [os.path.join(path, file_) for file_ in files]
-
-        # Dedupe and check existing files
-        files = [file_ for file_ in set(files) if os.path.exists(file_)]
+            files = [file_ for file_ in dict.fromkeys(files)
+                     if os.path.exists(file_)]
 
         if not files:
             return "No files in project %s" % project
 
+        # Split the files across a few concurrent runs of the script.  The
+        # first run's output goes straight to the handler so it can be
+        # polled live, the others are collected separately and added as each
+        # finishes so they don't get interleaved
+        workers = max(1, (os.cpu_count() or 2) // 2)
+        batches = [[] for i in range(workers)]
+        for (index, group) in enumerate(group_outputs(files).values()):
+            batches[index % workers].extend(group)
+        batches = [batch for batch in batches if batch]
+        buckets = [None] + [deque() for batch in batches[1:]]
+
         handler = self.handlers[myId]
-        for file_ in files:
-            command = ["convert_gstream.sh", "--factor", str(factor), file_]
-            with handler['lock']:
-                handler['data'].append(b"\n\n")
-            self.execCommand(command, myId)
+        handler['data'].append(self.batchHeader(0, len(batches)))
+        errors = []
+        with ThreadPoolExecutor(max_workers=len(batches)) as executor:
+            futures = {executor.submit(self.convertBatch, myId, project,
+                                       factor, index, batch,
+                                       buckets[index]): index
+                       for (index, batch) in enumerate(batches)}
+            for future in as_completed(futures):
+                index = futures[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    errors.append(str(e))
+                if buckets[index] is not None:
+                    handler['data'].append(self.batchHeader(index,
+                                                            len(batches)))
+                    handler['data'].extend(buckets[index])
+                    handler['newData'].set()
+
+        if errors:
+            raise Exception("\n\n".join(errors))
+
+    def batchHeader(self, index, count):
+        return ("\n\nBatch %s of %s:\n" % (index + 1, count)).encode("utf-8")
+
+    def convertBatch(self, myId, project, factor, index, files, bucket):
+        filelist = os.path.join("/opt/video/render/video", project,
+                                ".filelist-%d.txt" % index)
+        with open(filelist, "w") as f:
+            f.write("\n".join(files))
+            f.write("\n")
+
+        command = ["convert_gstream.sh", "--factor", str(factor),
+                   "--files-from", filelist]
+        try:
+            self.execCommand(command, myId, bucket)
+        finally:
+            os.unlink(filelist)
 
     def download_proxies(self, myId, project, remoteIP=None, force=False):
         path = os.path.join("/opt/video/render/video", project, "proxy", "")
@@ -289,8 +473,17 @@ class HandlerThread(Thread):
 
         if mode == 'cinelerra':
             if proxy:
-                # Copy the EDL file from proxy -> edit
-                shutil.copy(inedlfile, edlfile)
+                # Copy the EDL file from proxy -> edit.  A hardlink is safe
+                # as cinelerra-proxychange.py renames the original to .bak
+                # before writing the converted file
+                try:
+                    os.unlink(edlfile)
+                except FileNotFoundError:
+                    pass
+                try:
+                    os.link(inedlfile, edlfile)
+                except OSError:
+                    shutil.copyfile(inedlfile, edlfile)
 
                 # Convert the EDL file to remove the proxy factor,
                 # convert filenames
@@ -300,49 +493,12 @@ class HandlerThread(Thread):
                 self.execCommand(command, myId)
 
             # Create the batchfile
-            soup = BeautifulSoup("", "xml")
-            jobs = soup.new_tag("JOBS", WARN="1")
-            soup.append(jobs)
-            job = soup.new_tag("JOB", EDL_PATH=edlfile, STRATEGY="0",
-                               ENABLED="1", ELAPSED="0")
-            jobs.append(job)
-            asset = soup.new_tag("ASSET", SRC=outputfile)
-            job.append(asset)
-            folder = soup.new_tag("FOLDER", NUMBER="6")
-            folder.string = ""
-            asset.append(folder)
-            format_ = soup.new_tag("FORMAT", TYPE="FFMPEG", USE_HEADER="1",
-                                   FFORMAT="mp4")
-            format_.string = ""
-            asset.append(format_)
-            audio = soup.new_tag("AUDIO", CHANNELS="2", RATE="48000", BITS="16",
-                                 BYTE_ORDER="1", SIGNED="1", HEADER="0",
-                                 DITHER="0", ACODEC="h265.mp4",
-                                 AUDIO_LENGTH="0")
-            audio.string = ""
-            asset.append(audio)
-            video = soup.new_tag("VIDEO", ACTUAL_HEIGHT="0", ACTUAL_WIDTH="0",
-                                 HEIGHT="0", WIDTH="0", LAYERS="0",
-                                 PROGRAM="-1", FRAMERATE="0", VCODEC="h264.mp4",
-                                 VIDEO_LENGTH="0", SINGLE_FRAME="0",
-                                 INTERLACE_AUTOFIX='1',
-                                 INTERLACE_MODE="UNKNOWN",
-                                 INTERLACE_FIXMETHOD="SHIFT_UPONE",
-                                 REEL_NAME="cin0000", REEL_NUMBER="0",
-                                 TCSTART="0", TCEND="0", TCFORMAT="0")
-            video.string = ""
-            asset.append(video)
-            job.append("PATH %s" % outputfile)
-            job.append("AUDIO_CODEC h265.mp4")
-            job.append("VIDEO_CODEC h264.mp4")
-            job.append("FF_AUDIO_OPTIONS strict -2")
-            job.append("FF_AUDIO_BITRATE 0")
-            job.append("FF_VIDEO_OPTIONS crf=17")
-            job.append("FF_VIDEO_BITRATE 0")
-            job.append("FF_VIDEO_QUALITY -1")
-
+            attrEntities = {'"': "&quot;"}
+            batchXml = BATCHFILE_TEMPLATE.format(
+                edlfile=escape(edlfile, attrEntities),
+                outputfile=escape(outputfile, attrEntities))
             with open(batchfile, "w") as f:
-                f.write(soup.prettify())
+                f.write(batchXml)
 
             # Run the batch
             command = ["cin", "-r", batchfile]
@@ -404,6 +560,7 @@ def launch_thread(method, args):
     handlers[id_] = {
         "status": "queued",
         "queueTime": time.time(),
+        "newData": Event(),
     }
 
     logger.info("Queuing request for %s method %s (id %s)" %
@@ -411,9 +568,13 @@ def launch_thread(method, args):
     queue.put(data, block=False)
 
     global handlerThreads
-    if not handlerThreads.get(queueName, None):
-        handlerThreads[queueName] = HandlerThread(queue, queueName, handlers)
-        handlerThreads[queueName].start()
+    # Requests arrive on several threads, but each queue must only ever have
+    # the one consumer
+    with handlerThreadsLock:
+        if not handlerThreads.get(queueName, None):
+            handlerThreads[queueName] = HandlerThread(queue, queueName,
+                                                      handlers)
+            handlerThreads[queueName].start()
 
     return "Please poll with id %s" % id_
 
@@ -427,6 +588,12 @@ path += scriptpath
 path += ":/opt/video/render/scripts"
 os.environ['PATH'] = path
 
+# Resolve the commands we run once, rather than searching PATH on each exec
+commandPaths = {name: shutil.which(name) or name for name in (
+    "rsync", "cin", "convert_gstream.sh", "cinelerra-proxychange.py",
+    "render_pitivi.sh", "upload_video.py", "archive_to_s3.py",
+    "make_slideshow.py")}
+
 app = Flask(__name__)
 jsonrpc = JSONRPC(app, '/api', enable_web_browsable_api=False)
 
@@ -554,28 +721,56 @@ def make_slideshow(project: str, duration: float, outfile: str, files: List[str]
 
 
 
-@jsonrpc.method("App.poll", validate=True)
-def poll(id: str) -> Dict[str, Any]:
+def parse_since(since):
+    # App.poll isn't validated, so check the offset here
+    if since is None:
+        return None
+    try:
+        since = int(since)
+    except (TypeError, ValueError):
+        raise ValueError("Invalid since offset %r" % (since,))
+    if since < 0:
+        raise ValueError("Invalid since offset %r" % since)
+    return since
+
+def poll_handler(id, since=None):
     global handlers
     logger.info("Polling id %s" % id)
     if id not in handlers:
         raise Exception("No record of id %s" % id)
 
+    since = parse_since(since)
+
     handler = handlers[id]
     status = handler['status']
-    with handler['lock']:
-        handler['polldata'].append(b"".join(handler['data']))
-        handler['data'] = []
+    chunk = drain_output(handler, final=(status == "complete"))
+
+    # next always falls on a character boundary, but a client could pass
+    # any offset, so step back to the start of a character it splits
+    polldata = handler['polldata']
+    if since is not None:
+        for i in range(3):
+            if since >= len(polldata) or polldata[since] & 0xC0 != 0x80:
+                break
+            since -= 1
 
     result = {
         "status": status,
-        "result": handler['polldata'][-1].decode("utf-8"),
+        "result": chunk.decode("utf-8", "replace"),
         "queueDuration": handler['queueTime'],
         "processDuration": time.time() - handler['processTime'],
+        "next": len(handler['polldata']),
     }
 
+    # With an offset, return everything from there on, otherwise just the
+    # new output (and all of it once complete)
+    if since is not None:
+        result['result'] = handler['polldata'][since:].decode("utf-8",
+                                                              "replace")
+
     if status == "complete":
-        result['result'] = b"".join(handler['polldata']).decode("utf-8")
+        if since is None:
+            result['result'] = handler['polldata'].decode("utf-8", "replace")
         result["processDuration"] = handler['processTime']
         del handlers[id]
         if 'error' in handler:
@@ -583,7 +778,71 @@ def poll(id: str) -> Dict[str, Any]:
 
     return result
 
-@jsonrpc.method("App.list_outstanding", validate=True)
+# poll is the most frequently called method and its arguments are simple,
+# so skip the type validation
+@jsonrpc.method("App.poll", validate=False)
+def poll(id: str, since: int = None) -> Dict[str, Any]:
+    return poll_handler(id, since)
+
+# Same as App.poll without the JSON-RPC envelope
+@app.route("/api/poll/<id>")
+def poll_plain(id):
+    since = request.args.get("since", None)
+    status = 200
+    if id not in handlers:
+        result = {"error": "No record of id %s" % id}
+        status = 404
+    else:
+        try:
+            result = poll_handler(id, since)
+        except ValueError as e:
+            result = {"error": str(e)}
+            status = 400
+        except Exception as e:
+            result = {"error": str(e)}
+            status = 500
+
+    if orjson:
+        body = orjson.dumps(result)
+    else:
+        body = json.dumps(result)
+    return Response(body, status=status, mimetype="application/json")
+
+def stream_output(handler):
+    event = handler['newData']
+    while True:
+        # Check status before draining so the final output isn't missed,
+        # and before waiting as the event isn't set again once complete
+        complete = handler['status'] == "complete"
+        chunk = drain_output(handler, final=complete)
+        if chunk:
+            yield chunk
+        if complete:
+            return
+
+        # The event is shared with any other streams of this id, which may
+        # clear it before we see it, so only wait a bounded time before
+        # checking the status again
+        event.wait(5)
+        event.clear()
+
+# Streams only the new output as it arrives rather than the whole
+# accumulated output on every poll.  The handler is left in place so that
+# App.poll can still be used to collect the final status and any error.
+@app.route("/stream/<id>")
+def stream(id):
+    global handlers
+    logger.info("Streaming id %s" % id)
+    handler = handlers.get(id, None)
+    if handler is None:
+        return Response("No record of id %s\n" % id, status=404,
+                        mimetype="text/plain")
+
+    return Response(stream_output(handler),
+                    mimetype="application/octet-stream",
+                    headers={"X-Accel-Buffering": "no"})
+
+@jsonrpc.method("App.list_outstanding", validate=False)
 def list_outstanding() -> List[str]:
     global handlers
     logger.info("Listing outstanding tasks")
@@ -594,5 +853,49 @@ if __name__ == '__main__':
     logHandler = logging.StreamHandler()
     logFormatter = logging.Formatter(fmt=FORMAT)
     logHandler.setFormatter(logFormatter)
+    logHandlers = [fileHandler, logHandler]
+
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        BaseApplication = None
+
+    if not BaseApplication:
+        stop_logging()
+        start_logging(logHandlers)
+        app.run(host='0.0.0.0', port=5001, debug=False, threaded=True)
+        sys.exit(0)
+
+    class StandaloneApplication(BaseApplication):
+        def __init__(self, app, options):
+            self.application = app
+            self.options = options
+            BaseApplication.__init__(self)
+
+        def load_config(self):
+            for (key, value) in self.options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return self.application
+
+    def post_fork(server, worker):
+        # A fresh queue and listener thread for the worker, nothing is
+        # carried over from the master
+        start_logging(logHandlers)
+
+    # A single worker keeps the handlers and queues in one process, the
+    # threads let polls be serviced while other requests are in flight
+    options = {
+        "bind": "0.0.0.0:5001",
+        "workers": 1,
+        "threads": 16,
+        "worker_class": "gthread",
+        "post_fork": post_fork,
+    }
+
+    # Log directly in the master so it has no listener thread (or queue
+    # locks that thread might hold) when gunicorn forks the worker
+    stop_logging()
     logging.getLogger(None).addHandler(logHandler)
-    app.run(host='0.0.0.0', port=5001, debug=False)
+    StandaloneApplication(app, options).run()